@@ -7,7 +7,8 @@ setuptools.setup(
     description="Utility for moving message between SQS queues",
     url="https://github.com/kobybum/py-sqs-mover",
     packages=setuptools.find_packages(),
-    python_requires=">=3.6",
+    python_requires=">=3.8",
     scripts=["bin/sqsmover"],
-    install_requires=["boto3>=1.9.236"],
+    install_requires=["boto3>=1.24.84"],
+    extras_require={"orjson": ["orjson"], "async": ["aioboto3"]},
 )
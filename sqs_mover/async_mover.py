@@ -0,0 +1,534 @@
+import asyncio
+import functools
+import logging
+
+from typing import Callable, Coroutine, List, Optional, Sequence, Set
+
+from sqs_mover.client import CLIENT_CONFIG
+from sqs_mover.common import (
+    ALL_MESSAGE_ATTRIBUTES,
+    PREFETCH_COUNT,
+    NUM_RECEIVERS,
+    MAX_INFLIGHT_DELETES,
+    NUM_WORKERS,
+    PREFETCH_BATCHES,
+    WAIT_TIME_SECONDS,
+    InFlightMessages,
+    Messages,
+    MoveProgress,
+    batches,
+    check_pipeline_sizes,
+    delete_entries,
+    failed_messages,
+    heartbeat_schedule,
+    log_failed_extensions,
+    log_progress,
+    parse_messages,
+    receive_request,
+    receive_sizes,
+    send_entries,
+    visibility_entries,
+)
+
+try:
+    import aioboto3
+except ImportError:
+    aioboto3 = None  # type: ignore
+
+
+logger = logging.getLogger("sqs_mover")
+
+
+async def get_queue_url(sqs_client, queue_name: str) -> str:
+    return (await sqs_client.get_queue_url(QueueName=queue_name))["QueueUrl"]
+
+
+async def _receive_messages(
+    sqs_client,
+    queue_url: str,
+    message_batch_size: int,
+    wait_time_seconds: int,
+    visibility_timeout: Optional[int],
+    message_attribute_names: Optional[Sequence[str]],
+    on_received: Optional[Callable[[Messages], None]],
+) -> Messages:
+    response = await sqs_client.receive_message(
+        **receive_request(
+            queue_url,
+            message_batch_size,
+            wait_time_seconds,
+            visibility_timeout,
+            message_attribute_names,
+        )
+    )
+    messages = parse_messages(response.get("Messages"))
+    if on_received is not None and messages:
+        on_received(messages)
+    return messages
+
+
+async def get_messages(
+    sqs_client,
+    queue_url: str,
+    message_batch_size: int,
+    wait_time_seconds: int = WAIT_TIME_SECONDS,
+    visibility_timeout: Optional[int] = None,
+    message_attribute_names: Optional[Sequence[str]] = None,
+    on_received: Optional[Callable[[Messages], None]] = None,
+) -> Messages:
+    """asyncio version of `get_messages`, the requests of larger batches run concurrently."""
+    received = await asyncio.gather(
+        *(
+            _receive_messages(
+                sqs_client,
+                queue_url,
+                receive_size,
+                wait_time_seconds,
+                visibility_timeout,
+                message_attribute_names,
+                on_received,
+            )
+            for receive_size in receive_sizes(message_batch_size)
+        )
+    )
+    return [message for batch in received for message in batch]
+
+
+async def _send_request(sqs_client, queue_url: str, batch: Messages) -> Messages:
+    send_response = await sqs_client.send_message_batch(
+        QueueUrl=queue_url, Entries=send_entries(batch)
+    )
+    return failed_messages(batch, send_response, "send")
+
+
+async def _delete_request(sqs_client, queue_url: str, batch: Messages) -> Messages:
+    delete_response = await sqs_client.delete_message_batch(
+        QueueUrl=queue_url, Entries=delete_entries(batch)
+    )
+    return failed_messages(batch, delete_response, "delete")
+
+
+async def _visibility_request(
+    sqs_client,
+    queue_url: str,
+    batch: Messages,
+    visibility_timeout: int,
+    failure_action: Optional[str],
+) -> Messages:
+    visibility_response = await sqs_client.change_message_visibility_batch(
+        QueueUrl=queue_url, Entries=visibility_entries(batch, visibility_timeout)
+    )
+    return failed_messages(batch, visibility_response, failure_action)
+
+
+async def _for_each_batch(request, sqs_client, queue_url: str, messages: Messages) -> Messages:
+    """Run a request concurrently for each batch of up to 10 messages, returning the failures."""
+    failed_batches = await asyncio.gather(
+        *(request(sqs_client, queue_url, batch) for batch in batches(messages))
+    )
+    return [message for failed_batch in failed_batches for message in failed_batch]
+
+
+async def send_messages(sqs_client, queue_url: str, messages: Messages) -> Messages:
+    return await _for_each_batch(_send_request, sqs_client, queue_url, messages)
+
+
+async def delete_messages(sqs_client, queue_url: str, messages: Messages) -> Messages:
+    return await _for_each_batch(_delete_request, sqs_client, queue_url, messages)
+
+
+async def release_messages(sqs_client, queue_url: str, messages: Messages) -> Messages:
+    """asyncio version of `release_messages`."""
+    return await _for_each_batch(
+        functools.partial(
+            _visibility_request, visibility_timeout=0, failure_action="change visibility of"
+        ),
+        sqs_client,
+        queue_url,
+        messages,
+    )
+
+
+async def extend_visibility(
+    sqs_client, queue_url: str, messages: Messages, visibility_timeout: int
+) -> Messages:
+    """asyncio version of `extend_visibility`."""
+    return await _for_each_batch(
+        functools.partial(
+            _visibility_request, visibility_timeout=visibility_timeout, failure_action=None
+        ),
+        sqs_client,
+        queue_url,
+        messages,
+    )
+
+
+async def get_approximate_queue_size(sqs_client, queue_url: str) -> str:
+    queue_attributes = await sqs_client.get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessages"]
+    )
+    return queue_attributes["Attributes"]["ApproximateNumberOfMessages"]
+
+
+async def _acquire_unless_stopped(in_flight: asyncio.Semaphore, stop: asyncio.Event) -> bool:
+    """Wait for an in-flight slot, giving up once the move is stopped."""
+    acquire = asyncio.ensure_future(in_flight.acquire())
+    stopped = asyncio.ensure_future(stop.wait())
+    try:
+        await asyncio.wait([acquire, stopped], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopped.cancel()
+        acquire.cancel()
+
+    if not acquire.done() or acquire.cancelled():
+        return False
+    if stop.is_set():
+        in_flight.release()
+        return False
+    return True
+
+
+async def _receive_loop(
+    sqs_client,
+    queue_url: str,
+    message_batch_size: int,
+    wait_time_seconds: int,
+    visibility_timeout: Optional[int],
+    send_queue: asyncio.Queue,
+    in_flight: asyncio.Semaphore,
+    in_flight_messages: InFlightMessages,
+    stop: asyncio.Event,
+):
+    while not stop.is_set():
+        if not await _acquire_unless_stopped(in_flight, stop):
+            return
+
+        messages = await get_messages(
+            sqs_client,
+            queue_url,
+            message_batch_size,
+            wait_time_seconds,
+            visibility_timeout,
+            ALL_MESSAGE_ATTRIBUTES,
+            on_received=in_flight_messages.add,
+        )
+        if not messages:
+            in_flight.release()
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received messages: %s", messages)
+        send_queue.put_nowait(messages)
+
+
+async def _delete_batch(
+    sqs_client,
+    source_url: str,
+    messages: Messages,
+    in_flight: asyncio.Semaphore,
+    in_flight_messages: InFlightMessages,
+    stop: asyncio.Event,
+    progress: MoveProgress,
+):
+    in_flight_messages.remove(messages)
+    try:
+        failed_deletions = await delete_messages(sqs_client, source_url, messages)
+    finally:
+        in_flight.release()
+
+    if failed_deletions:
+        stop.set()
+        return
+
+    messages_moved = progress.update(len(messages))
+    if messages_moved is not None:
+        log_progress(messages_moved, await get_approximate_queue_size(sqs_client, source_url))
+
+
+class _BackgroundDeletions:
+    """
+    Delete tasks that run in the background, so a sender moves on to its next batch without
+    waiting for the previous delete. At most `max_inflight` deletes run at once, and the first
+    failed task stops the move.
+    """
+
+    def __init__(self, stop: asyncio.Event, max_inflight: int):
+        self._stop = stop
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._tasks: Set[asyncio.Task] = set()
+        self.error: Optional[BaseException] = None
+
+    def start(self, deletion: Coroutine):
+        task = asyncio.ensure_future(self._run(deletion))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_done)
+
+    async def _run(self, deletion: Coroutine):
+        async with self._slots:
+            await deletion
+
+    def _on_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._stop.set()
+            self.error = self.error or task.exception()
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+async def _send_worker(
+    sqs_client,
+    source_url: str,
+    dest_url: str,
+    send_queue: asyncio.Queue,
+    in_flight: asyncio.Semaphore,
+    in_flight_messages: InFlightMessages,
+    stop: asyncio.Event,
+    deletions: _BackgroundDeletions,
+    progress: MoveProgress,
+):
+    while True:
+        messages = await send_queue.get()
+        if messages is None:
+            return
+
+        # Once stopped, drain the received batches and return them to the source queue
+        if stop.is_set():
+            in_flight_messages.remove(messages)
+            try:
+                await release_messages(sqs_client, source_url, messages)
+            finally:
+                in_flight.release()
+            continue
+
+        failed_sends = await send_messages(sqs_client, dest_url, messages)
+        if failed_sends:
+            stop.set()
+            in_flight_messages.remove(messages)
+            in_flight.release()
+            continue
+
+        # Batches that were sent are always deleted, even after a stop, to avoid duplicates
+        deletions.start(
+            _delete_batch(
+                sqs_client, source_url, messages, in_flight, in_flight_messages, stop, progress
+            )
+        )
+
+
+async def _extend_in_flight(
+    sqs_client,
+    queue_url: str,
+    visibility_timeout: int,
+    in_flight_messages: InFlightMessages,
+    shut_down: asyncio.Task,
+):
+    interval, due_age = heartbeat_schedule(visibility_timeout)
+    while True:
+        finished, _ = await asyncio.wait([shut_down], timeout=interval)
+        if finished:
+            return
+
+        due_messages = in_flight_messages.due(due_age)
+        if not due_messages:
+            continue
+
+        failed_extensions = await extend_visibility(
+            sqs_client, queue_url, due_messages, visibility_timeout
+        )
+        log_failed_extensions(in_flight_messages, failed_extensions)
+
+
+async def _release_queued(
+    sqs_client, source_url: str, send_queue: asyncio.Queue, in_flight_messages: InFlightMessages
+):
+    """Return the batches no sender got to back to the source queue, as stopped senders do."""
+    while not send_queue.empty():
+        messages = send_queue.get_nowait()
+        if messages is not None:
+            in_flight_messages.remove(messages)
+            await release_messages(sqs_client, source_url, messages)
+
+
+async def _stop_after_failure(
+    sqs_client,
+    source_url: str,
+    receivers: List[asyncio.Task],
+    senders: List[asyncio.Task],
+    send_queue: asyncio.Queue,
+    deletions: _BackgroundDeletions,
+    in_flight_messages: InFlightMessages,
+):
+    """
+    Wind the stages down the way the threaded mover does once a task raised - the receivers stop,
+    the remaining senders release the queued batches and the sent batches are deleted.
+    """
+    await asyncio.wait(receivers)
+    for _ in senders:
+        send_queue.put_nowait(None)
+    await asyncio.wait(senders)
+    await deletions.join()
+    # Batches are only left over when every sender failed
+    await _release_queued(sqs_client, source_url, send_queue, in_flight_messages)
+
+
+async def _shut_down(
+    receivers: List[asyncio.Task],
+    senders: List[asyncio.Task],
+    send_queue: asyncio.Queue,
+    deletions: _BackgroundDeletions,
+):
+    """Stop each stage once the stage feeding it has finished."""
+    # Waited without gather, cancelling the shut down mustn't cancel the stages it waits for
+    await asyncio.wait(receivers)
+    for _ in senders:
+        send_queue.put_nowait(None)
+    await asyncio.wait(senders)
+    await deletions.join()
+
+
+async def move_messages_async(
+    source_queue_name: str,
+    dest_queue_name: str,
+    message_batch_size: int = PREFETCH_COUNT,
+    sqs_client=None,
+    wait_time_seconds: int = WAIT_TIME_SECONDS,
+    num_workers: int = NUM_WORKERS,
+    prefetch_batches: int = PREFETCH_BATCHES,
+    num_receivers: int = NUM_RECEIVERS,
+    max_inflight_deletes: int = MAX_INFLIGHT_DELETES,
+    visibility_timeout: Optional[int] = None,
+):
+    """
+    asyncio version of `move_messages`, requires aioboto3.
+    Receiver and sender tasks on a single event loop are connected by a queue, and each sent batch
+    is deleted by a background task that is only awaited at the end of the move. At most
+    `max_inflight_deletes` deletes run at once, and with a `visibility_timeout` a heartbeat task
+    keeps extending the batches that are still in flight.
+    At most `prefetch_batches` batches are in flight, and the first failed send or delete stops
+    the move.
+    """
+    check_pipeline_sizes(
+        message_batch_size=message_batch_size,
+        num_workers=num_workers,
+        prefetch_batches=prefetch_batches,
+        num_receivers=num_receivers,
+        max_inflight_deletes=max_inflight_deletes,
+    )
+    if sqs_client is None:
+        if aioboto3 is None:
+            raise ImportError(
+                "aioboto3 is required to create an async client, pip install sqs_mover[async]"
+            )
+        async with aioboto3.Session().client("sqs", config=CLIENT_CONFIG) as sqs_client:
+            return await move_messages_async(
+                source_queue_name,
+                dest_queue_name,
+                message_batch_size,
+                sqs_client,
+                wait_time_seconds,
+                num_workers,
+                prefetch_batches,
+                num_receivers,
+                max_inflight_deletes,
+                visibility_timeout,
+            )
+
+    source_url = await get_queue_url(sqs_client, source_queue_name)
+    dest_url = await get_queue_url(sqs_client, dest_queue_name)
+
+    total_messages = await get_approximate_queue_size(sqs_client, source_url)
+
+    logger.info(
+        "Moving %s messages from %s to %s", total_messages, source_queue_name, dest_queue_name
+    )
+
+    send_queue: "asyncio.Queue[Optional[Messages]]" = asyncio.Queue()
+    in_flight = asyncio.Semaphore(prefetch_batches)
+    in_flight_messages = InFlightMessages()
+    stop = asyncio.Event()
+    progress = MoveProgress()
+    deletions = _BackgroundDeletions(stop, max_inflight_deletes)
+
+    receivers = [
+        asyncio.ensure_future(
+            _receive_loop(
+                sqs_client,
+                source_url,
+                message_batch_size,
+                wait_time_seconds,
+                visibility_timeout,
+                send_queue,
+                in_flight,
+                in_flight_messages,
+                stop,
+            )
+        )
+        for _ in range(num_receivers)
+    ]
+    senders = [
+        asyncio.ensure_future(
+            _send_worker(
+                sqs_client,
+                source_url,
+                dest_url,
+                send_queue,
+                in_flight,
+                in_flight_messages,
+                stop,
+                deletions,
+                progress,
+            )
+        )
+        for _ in range(num_workers)
+    ]
+
+    shut_down = asyncio.ensure_future(_shut_down(receivers, senders, send_queue, deletions))
+    tasks = receivers + senders + [shut_down]
+    if visibility_timeout:
+        tasks.append(
+            asyncio.ensure_future(
+                _extend_in_flight(
+                    sqs_client, source_url, visibility_timeout, in_flight_messages, shut_down
+                )
+            )
+        )
+
+    # A failed task would leave the stages waiting on it blocked, so stop on the first exception
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        if any(task.done() and not task.cancelled() and task.exception() for task in tasks):
+            stop.set()
+            shut_down.cancel()
+            await _stop_after_failure(
+                sqs_client,
+                source_url,
+                receivers,
+                senders,
+                send_queue,
+                deletions,
+                in_flight_messages,
+            )
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Batches that were sent are always deleted, only a second interrupt abandons the deletes
+        try:
+            await deletions.join()
+        except BaseException:
+            deletions.cancel()
+            raise
+
+    for task in tasks:
+        if task.done() and not task.cancelled():
+            task.result()
+    if deletions.error is not None:
+        raise deletions.error
+
+    logger.info("Moved %d total messages", progress.messages)
@@ -0,0 +1,50 @@
+import boto3
+import threading
+
+from botocore.config import Config
+from typing import Optional
+
+# Enough pooled connections for every thread of a default move to have a request in flight
+MAX_POOL_CONNECTIONS = 64
+
+# Pooled keep-alive connections avoid a TLS handshake per request.
+# The read timeout must outlast the longest SQS long poll (20 seconds), otherwise botocore aborts
+# (and retries) the request.
+# Our requests always have the same shape, so client-side parameter validation is skipped and
+# SQS rejects anything malformed instead.
+CLIENT_CONFIG = Config(
+    defaults_mode="standard",
+    parameter_validation=False,
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive", "max_attempts": 10},
+    connect_timeout=5,
+    read_timeout=30,
+)
+
+_session: Optional[boto3.session.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> boto3.session.Session:
+    """
+    The process-wide boto3 session, created on first use.
+    Sharing it resolves credentials, region and endpoint data once for all clients.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def build_client(max_pool_connections: int = MAX_POOL_CONNECTIONS):
+    """
+    Build an SQS client using `CLIENT_CONFIG`, with at least `max_pool_connections` pooled
+    connections. Use this rather than `boto3.client("sqs")`, which opens a new connection (and TLS
+    handshake) per request once more threads share the client than it has pooled connections.
+    """
+    config = CLIENT_CONFIG.merge(
+        Config(max_pool_connections=max(max_pool_connections, MAX_POOL_CONNECTIONS))
+    )
+    return get_session().client("sqs", config=config)
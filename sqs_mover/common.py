@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+import types
+
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+
+class Message(NamedTuple):
+    message_id: str
+    body: str
+    attributes: Optional[Mapping]
+    receipt_handle: str
+
+
+Messages = List[Message]
+
+# The maximum number of messages SQS accepts in a single receive, send or delete batch
+MESSAGE_BATCH_SIZE = 10
+
+# Messages requested each iteration by default, larger counts are received with concurrent requests
+PREFETCH_COUNT = MESSAGE_BATCH_SIZE
+
+# Long polling - receive_message blocks up to this many seconds while the queue is empty
+WAIT_TIME_SECONDS = 20
+
+# Received batches held by the move pipeline at once, the rest stay visible in the source queue
+PREFETCH_BATCHES = 8
+
+# Receivers concurrently receiving batches from the source queue
+NUM_RECEIVERS = 4
+
+# Workers sending received batches to the destination
+NUM_WORKERS = 4
+
+# Moved messages keep all of their message attributes
+ALL_MESSAGE_ATTRIBUTES = ["All"]
+
+# Delete requests for sent batches that may run concurrently
+MAX_INFLIGHT_DELETES = 8
+
+# Minimum seconds between progress log lines while moving
+PROGRESS_LOG_INTERVAL = 5.0
+
+logger = logging.getLogger("sqs_mover")
+
+# Shared by every received message without attributes instead of allocating an empty dict each,
+# read-only so a caller mutating one message's attributes can't change every other message's
+_NO_ATTRIBUTES: Mapping = types.MappingProxyType({})
+
+
+def receive_sizes(message_count: int) -> List[int]:
+    """Split a message count into receive requests of at most `MESSAGE_BATCH_SIZE` messages."""
+    full_requests, remainder = divmod(message_count, MESSAGE_BATCH_SIZE)
+    return [MESSAGE_BATCH_SIZE] * full_requests + ([remainder] if remainder else [])
+
+
+def batches(messages: Messages) -> List[Messages]:
+    """Split messages into batches SQS accepts in a single send / delete request."""
+    if len(messages) <= MESSAGE_BATCH_SIZE:
+        return [messages]
+
+    message_batches = []
+    for start in range(0, len(messages), MESSAGE_BATCH_SIZE):
+        end = start + MESSAGE_BATCH_SIZE
+        message_batches.append(messages[start:end])
+    return message_batches
+
+
+def receive_request(
+    queue_url: str,
+    message_batch_size: int,
+    wait_time_seconds: int,
+    visibility_timeout: Optional[int],
+    message_attribute_names: Optional[Sequence[str]],
+) -> Dict:
+    request = {
+        "QueueUrl": queue_url,
+        "MaxNumberOfMessages": message_batch_size,
+        "WaitTimeSeconds": wait_time_seconds,
+    }
+    # Without a timeout the queue's default visibility timeout applies
+    if visibility_timeout is not None:
+        request["VisibilityTimeout"] = visibility_timeout
+    # Attributes are only returned when requested, which keeps responses small
+    if message_attribute_names is not None:
+        request["MessageAttributeNames"] = message_attribute_names
+    return request
+
+
+def parse_messages(raw_messages: Optional[List[Dict]]) -> Messages:
+    if not raw_messages:
+        return []
+
+    return [
+        Message(
+            raw_message["MessageId"],
+            raw_message["Body"],
+            raw_message.get("MessageAttributes") or _NO_ATTRIBUTES,
+            raw_message["ReceiptHandle"],
+        )
+        for raw_message in raw_messages
+    ]
+
+
+def failed_messages(messages: Messages, batch_response: Dict, action: Optional[str]) -> Messages:
+    """
+    The messages listed as failed in a batch response, by their entry Id. Failed responses are
+    logged as failing to `action` the messages, unless `action` is None.
+    """
+    failures = batch_response.get("Failed")
+    if not failures:
+        return []
+
+    if action is not None:
+        logger.error("Failed to %s messages: %s", action, batch_response)
+
+    failed_ids = {failure["Id"] for failure in failures}
+    return [message for message in messages if message.message_id in failed_ids]
+
+
+def send_entries(messages: Messages) -> List[Dict]:
+    # Most messages have no attributes, leave the key out rather than serialize an empty map
+    return [
+        (
+            {
+                "Id": message.message_id,
+                "MessageBody": message.body,
+                "MessageAttributes": message.attributes,
+            }
+            if message.attributes
+            else {"Id": message.message_id, "MessageBody": message.body}
+        )
+        for message in messages
+    ]
+
+
+def delete_entries(messages: Messages) -> List[Dict]:
+    return [
+        {"Id": message.message_id, "ReceiptHandle": message.receipt_handle} for message in messages
+    ]
+
+
+def visibility_entries(messages: Messages, visibility_timeout: int) -> List[Dict]:
+    return [
+        {
+            "Id": message.message_id,
+            "ReceiptHandle": message.receipt_handle,
+            "VisibilityTimeout": visibility_timeout,
+        }
+        for message in messages
+    ]
+
+
+def check_pipeline_sizes(**sizes: int):
+    # A stage without workers or in-flight slots never finishes, so the move would hang
+    for name, size in sizes.items():
+        if size < 1:
+            raise ValueError("%s must be a positive integer, got %s" % (name, size))
+
+
+class MoveProgress:
+    """Thread-safe count of moved messages, due to be logged at most every few seconds."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last_logged = time.monotonic()
+        self.messages = 0
+
+    def update(self, message_count: int) -> Optional[int]:
+        """Count moved messages, returning the total moved when progress is due to be logged."""
+        now = time.monotonic()
+        with self._lock:
+            self.messages += message_count
+            if now - self._last_logged < PROGRESS_LOG_INTERVAL:
+                return None
+
+            self._last_logged = now
+            return self.messages
+
+
+def log_progress(messages_moved: int, total_messages: str):
+    logger.info("Moved %d messages, approximately %s left", messages_moved, total_messages)
+
+
+class InFlightMessages:
+    """
+    Thread-safe set of received messages that were not deleted or released yet, with the time their
+    visibility timeout was last set.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Receipt handle -> (monotonic time the visibility timeout was set, message)
+        self._messages: Dict[str, Tuple[float, Message]] = {}
+
+    def add(self, messages: Messages):
+        now = time.monotonic()
+        with self._lock:
+            for message in messages:
+                self._messages[message.receipt_handle] = (now, message)
+
+    def remove(self, messages: Messages):
+        with self._lock:
+            for message in messages:
+                self._messages.pop(message.receipt_handle, None)
+
+    def due(self, age: float) -> Messages:
+        """Messages whose visibility timeout was set at least `age` seconds ago, resetting it."""
+        now = time.monotonic()
+        with self._lock:
+            due_messages = [
+                message for set_at, message in self._messages.values() if now - set_at >= age
+            ]
+            for message in due_messages:
+                self._messages[message.receipt_handle] = (now, message)
+        return due_messages
+
+    def pending(self, messages: Messages) -> Messages:
+        """The given messages that are still in flight."""
+        with self._lock:
+            return [message for message in messages if message.receipt_handle in self._messages]
+
+
+def heartbeat_schedule(visibility_timeout: int) -> Tuple[float, float]:
+    """
+    Seconds between heartbeats, and the age at which a message's visibility is extended - halfway
+    through its timeout, before it becomes visible to other consumers.
+    """
+    return visibility_timeout / 4, visibility_timeout / 2
+
+
+def log_failed_extensions(in_flight_messages: InFlightMessages, failed_extensions: Messages):
+    # Messages deleted or released since they were due can't be extended, which is expected
+    failed_in_flight = in_flight_messages.pending(failed_extensions)
+    if failed_in_flight:
+        logger.error("Failed to extend visibility of messages: %s", failed_in_flight)
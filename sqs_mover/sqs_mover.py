@@ -2,142 +2,525 @@
 
 import logging
 import argparse
-import boto3
+import asyncio
+import functools
 import json
-
-from typing import Dict, Tuple, NamedTuple, Optional
-
-
-class Message(NamedTuple):
-    message_id: str
-    body: str
-    attributes: Optional[Dict]
-    receipt_handle: str
-
-
-Messages = Tuple[Message, ...]
-
+import queue
+import threading
+import time
+import weakref
+
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Tuple, Optional, Sequence
+
+from sqs_mover.client import build_client
+from sqs_mover.common import (
+    ALL_MESSAGE_ATTRIBUTES,
+    MAX_INFLIGHT_DELETES,
+    MESSAGE_BATCH_SIZE,
+    NUM_RECEIVERS,
+    NUM_WORKERS,
+    PREFETCH_BATCHES,
+    PREFETCH_COUNT,
+    WAIT_TIME_SECONDS,
+    InFlightMessages,
+    Messages,
+    MoveProgress,
+    batches,
+    check_pipeline_sizes,
+    delete_entries,
+    failed_messages,
+    heartbeat_schedule,
+    log_failed_extensions,
+    log_progress,
+    parse_messages,
+    receive_request,
+    receive_sizes,
+    send_entries,
+    visibility_entries,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+# Seconds an approximate queue size is reused before asking SQS again
+QUEUE_SIZE_TTL = 5.0
+
+# How often blocked pipeline threads check whether the move was stopped
+STOP_CHECK_INTERVAL = 0.5
 
 logger = logging.getLogger("sqs_mover")
 
+# Client -> queue name -> queue URL, clients of different accounts can share an endpoint.
+# Weakly keyed so cached clients and their connection pools aren't kept alive
+_queue_urls: "weakref.WeakKeyDictionary[Any, Dict[str, str]]" = weakref.WeakKeyDictionary()
 
-def get_queue_url(sqs_client, queue_name: str) -> str:
-    return sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+# Queue URL -> (monotonic time fetched, approximate size)
+_queue_sizes: Dict[str, Tuple[float, str]] = {}
 
 
-def get_messages(sqs_client, queue_url: str, message_batch_size: int) -> Messages:
+def get_queue_url(sqs_client, queue_name: str) -> str:
+    client_queue_urls = _queue_urls.setdefault(sqs_client, {})
+    queue_url = client_queue_urls.get(queue_name)
+    if queue_url is None:
+        # Failed lookups raise before anything is cached, so they are retried on the next call
+        queue_url = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+        client_queue_urls[queue_name] = queue_url
+    return queue_url
+
+
+def _receive_messages(
+    sqs_client,
+    queue_url: str,
+    message_batch_size: int,
+    wait_time_seconds: int,
+    visibility_timeout: Optional[int] = None,
+    message_attribute_names: Optional[Sequence[str]] = None,
+    on_received: Optional[Callable[[Messages], None]] = None,
+) -> Messages:
     raw_messages = sqs_client.receive_message(
-        QueueUrl=queue_url, MaxNumberOfMessages=message_batch_size, MessageAttributeNames=["All"]
+        **receive_request(
+            queue_url,
+            message_batch_size,
+            wait_time_seconds,
+            visibility_timeout,
+            message_attribute_names,
+        )
     ).get("Messages")
 
-    if not raw_messages:
-        return tuple()
-
-    return tuple(
-        Message(
-            message_id=raw_message["MessageId"],
-            body=raw_message["Body"],
-            attributes=raw_message.get("MessageAttributes", {}),
-            receipt_handle=raw_message["ReceiptHandle"],
+    messages = parse_messages(raw_messages)
+    if on_received is not None and messages:
+        on_received(messages)
+    return messages
+
+
+def get_messages(
+    sqs_client,
+    queue_url: str,
+    message_batch_size: int,
+    wait_time_seconds: int = WAIT_TIME_SECONDS,
+    visibility_timeout: Optional[int] = None,
+    message_attribute_names: Optional[Sequence[str]] = None,
+    executor: Optional[Executor] = None,
+    on_received: Optional[Callable[[Messages], None]] = None,
+) -> Messages:
+    """
+    Receive up to `message_batch_size` messages. SQS returns at most 10 messages per request,
+    so larger batches are received with concurrent requests on `executor`, or on a temporary
+    thread pool without one. `on_received` is called with the messages of each request as soon
+    as it returns, before the others finish.
+    Message attributes are only received for `message_attribute_names`, or all with `["All"]`.
+    """
+    if message_batch_size <= MESSAGE_BATCH_SIZE:
+        return _receive_messages(
+            sqs_client,
+            queue_url,
+            message_batch_size,
+            wait_time_seconds,
+            visibility_timeout,
+            message_attribute_names,
+            on_received,
         )
-        for raw_message in raw_messages
+
+    receive = functools.partial(
+        _receive_messages,
+        sqs_client,
+        queue_url,
+        wait_time_seconds=wait_time_seconds,
+        visibility_timeout=visibility_timeout,
+        message_attribute_names=message_attribute_names,
+        on_received=on_received,
     )
+    request_sizes = receive_sizes(message_batch_size)
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=len(request_sizes)) as temporary_executor:
+            received = list(temporary_executor.map(receive, request_sizes))
+    else:
+        received = list(executor.map(receive, request_sizes))
 
+    return [message for batch in received for message in batch]
 
-def send_messages(sqs_client, queue_url: str, messages: Messages) -> Messages:
-    send_entries = [
-        {
-            "Id": message.message_id,
-            "MessageBody": message.body,
-            "MessageAttributes": message.attributes,
-        }
-        for message in messages
-    ]
 
-    logger.debug("Sending: %s", send_entries)
+def send_messages(sqs_client, queue_url: str, messages: Messages) -> Messages:
+    failed_sends: Messages = []
+    for batch in batches(messages):
+        entries = send_entries(batch)
 
-    send_response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=send_entries)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending: %s", entries)
 
-    failed_ids = {failure["MessageId"] for failure in send_response.get("Failed", [])}
-    if failed_ids:
-        logger.error("Failed to send messages: %s", send_response)
+        send_response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed_sends.extend(failed_messages(batch, send_response, "send"))
 
-    return tuple(message for message in messages if message.message_id in failed_ids)
+    return failed_sends
 
 
 def delete_messages(sqs_client, queue_url: str, messages: Messages) -> Messages:
-    delete_entries = [
-        {"Id": message.message_id, "ReceiptHandle": message.receipt_handle} for message in messages
-    ]
+    failed_deletions: Messages = []
+    for batch in batches(messages):
+        delete_response = sqs_client.delete_message_batch(
+            QueueUrl=queue_url, Entries=delete_entries(batch)
+        )
+        failed_deletions.extend(failed_messages(batch, delete_response, "delete"))
+
+    return failed_deletions
+
+
+def _change_visibility(
+    sqs_client,
+    queue_url: str,
+    messages: Messages,
+    visibility_timeout: int,
+    failure_action: Optional[str],
+) -> Messages:
+    failed_changes: Messages = []
+    for batch in batches(messages):
+        visibility_response = sqs_client.change_message_visibility_batch(
+            QueueUrl=queue_url, Entries=visibility_entries(batch, visibility_timeout)
+        )
+        failed_changes.extend(failed_messages(batch, visibility_response, failure_action))
+
+    return failed_changes
 
-    delete_response = sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=delete_entries)
 
-    failed_ids = {failure["MessageId"] for failure in delete_response.get("Failed", [])}
-    if failed_ids:
-        logger.error("Failed to delete messages: %s", delete_response)
+def release_messages(sqs_client, queue_url: str, messages: Messages) -> Messages:
+    """Make received messages visible in the queue again, without waiting for their timeout."""
+    return _change_visibility(sqs_client, queue_url, messages, 0, "change visibility of")
 
-    return tuple(message for message in messages if message.message_id in failed_ids)
+
+def extend_visibility(
+    sqs_client, queue_url: str, messages: Messages, visibility_timeout: int
+) -> Messages:
+    """
+    Keep received messages hidden from other consumers for another `visibility_timeout`.
+    Failures are returned without logging them, messages deleted in the meantime fail as well.
+    """
+    return _change_visibility(sqs_client, queue_url, messages, visibility_timeout, None)
 
 
 def get_approximate_queue_size(sqs_client, queue_url: str) -> str:
+    cached = _queue_sizes.get(queue_url)
+    if cached and time.monotonic() - cached[0] < QUEUE_SIZE_TTL:
+        return cached[1]
+
     queue_attributes = sqs_client.get_queue_attributes(
         QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessages"]
     )
-    return queue_attributes["Attributes"]["ApproximateNumberOfMessages"]
-
-
-def move_messages(
-    source_queue_name: str, dest_queue_name: str, message_batch_size: int, sqs_client=None
+    queue_size = queue_attributes["Attributes"]["ApproximateNumberOfMessages"]
+    _queue_sizes[queue_url] = (time.monotonic(), queue_size)
+    return queue_size
+
+
+def _run_stage(stop: threading.Event, stage, *args):
+    try:
+        return stage(*args)
+    except BaseException:
+        stop.set()
+        raise
+
+
+def _receive_batches(
+    sqs_client,
+    queue_url: str,
+    message_batch_size: int,
+    wait_time_seconds: int,
+    visibility_timeout: Optional[int],
+    executor: Executor,
+    send_queue: queue.Queue,
+    in_flight: threading.Semaphore,
+    in_flight_messages: InFlightMessages,
+    stop: threading.Event,
 ):
-    sqs_client = sqs_client or boto3.client("sqs")
+    while not stop.is_set():
+        if not in_flight.acquire(timeout=STOP_CHECK_INTERVAL):
+            continue
+
+        messages = get_messages(
+            sqs_client,
+            queue_url,
+            message_batch_size,
+            wait_time_seconds,
+            visibility_timeout,
+            ALL_MESSAGE_ATTRIBUTES,
+            executor=executor,
+            # Tracked per request, a request can return long before the other long polls
+            on_received=in_flight_messages.add,
+        )
+        if not messages:
+            in_flight.release()
+            return
 
-    source_url = get_queue_url(sqs_client, source_queue_name)
-    dest_url = get_queue_url(sqs_client, dest_queue_name)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received messages: %s", messages)
+        send_queue.put(messages)
 
-    total_messages = get_approximate_queue_size(sqs_client, source_url)
 
-    logger.info(
-        "Moving %s messages from %s to %s", total_messages, source_queue_name, dest_queue_name
-    )
-
-    messages = None
-    messages_moved = 0
-    i = 0
+def _send_batches(
+    sqs_client,
+    source_url: str,
+    dest_url: str,
+    send_queue: queue.Queue,
+    delete_queue: queue.Queue,
+    in_flight: threading.Semaphore,
+    in_flight_messages: InFlightMessages,
+    stop: threading.Event,
+):
     while True:
-        messages = get_messages(sqs_client, source_url, message_batch_size)
-        if not messages:
-            break
+        messages = send_queue.get()
+        if messages is None:
+            return
 
-        logger.debug("Received messages: %s", messages)
+        # Once stopped, drain the received batches and return them to the source queue
+        if stop.is_set():
+            in_flight_messages.remove(messages)
+            try:
+                release_messages(sqs_client, source_url, messages)
+            finally:
+                in_flight.release()
+            continue
 
         failed_sends = send_messages(sqs_client, dest_url, messages)
         if failed_sends:
+            stop.set()
+            in_flight_messages.remove(messages)
+            in_flight.release()
+            continue
+
+        delete_queue.put(messages)
+
+
+def _delete_batches(
+    sqs_client,
+    source_url: str,
+    delete_queue: queue.Queue,
+    in_flight: threading.Semaphore,
+    in_flight_messages: InFlightMessages,
+    stop: threading.Event,
+    progress: MoveProgress,
+):
+    # Batches that were sent are always deleted, even after a stop, to avoid duplicates
+    while True:
+        messages = delete_queue.get()
+        if messages is None:
             return
 
-        failed_deletions = delete_messages(sqs_client, source_url, messages)
+        in_flight_messages.remove(messages)
+        try:
+            failed_deletions = delete_messages(sqs_client, source_url, messages)
+        finally:
+            in_flight.release()
+
         if failed_deletions:
-            return
+            stop.set()
+            continue
+
+        messages_moved = progress.update(len(messages))
+        if messages_moved is not None:
+            log_progress(messages_moved, get_approximate_queue_size(sqs_client, source_url))
+
+
+def _extend_in_flight(
+    sqs_client,
+    queue_url: str,
+    visibility_timeout: int,
+    in_flight_messages: InFlightMessages,
+    done: threading.Event,
+):
+    interval, due_age = heartbeat_schedule(visibility_timeout)
+    while not done.wait(interval):
+        due_messages = in_flight_messages.due(due_age)
+        if not due_messages:
+            continue
+
+        failed_extensions = extend_visibility(
+            sqs_client, queue_url, due_messages, visibility_timeout
+        )
+        log_failed_extensions(in_flight_messages, failed_extensions)
 
-        i += 1
-        messages_moved += len(messages)
 
-        if i % 10 == 0:
-            total_messages = get_approximate_queue_size(sqs_client, source_url)
-            logger.info("Moved %d messages, approximately %s left", messages_moved, total_messages)
+def _close_stage(stage_queue: queue.Queue, workers: List[Future]):
+    """Signal each worker of a stage to exit once its queue is drained, and wait for them."""
+    for _ in workers:
+        stage_queue.put(None)
+    wait(workers)
 
-    logger.info("Moved %d total messages", messages_moved)
 
+def move_messages(
+    source_queue_name: str,
+    dest_queue_name: str,
+    message_batch_size: int = PREFETCH_COUNT,
+    sqs_client=None,
+    wait_time_seconds: int = WAIT_TIME_SECONDS,
+    num_workers: int = NUM_WORKERS,
+    prefetch_batches: int = PREFETCH_BATCHES,
+    num_receivers: int = NUM_RECEIVERS,
+    max_inflight_deletes: int = MAX_INFLIGHT_DELETES,
+    visibility_timeout: Optional[int] = None,
+):
+    """
+    Move messages in a pipeline of three stages connected by queues - `num_receivers` threads
+    receive batches from the source queue, `num_workers` threads send them to the destination
+    and `max_inflight_deletes` threads delete the sent batches from the source in the background.
+    At most `prefetch_batches` batches are in flight, and the first failed send or delete stops
+    the move.
+    With a `visibility_timeout`, received messages are hidden for that many seconds, and a
+    heartbeat thread keeps extending the batches that are still in flight.
+
+    boto3 clients are thread-safe, all threads share `sqs_client` and its connection pool.
+    """
+    check_pipeline_sizes(
+        message_batch_size=message_batch_size,
+        num_workers=num_workers,
+        prefetch_batches=prefetch_batches,
+        num_receivers=num_receivers,
+        max_inflight_deletes=max_inflight_deletes,
+    )
+    num_heartbeats = 1 if visibility_timeout else 0
+    # Receives of more than 10 messages run their requests concurrently on the pipeline's pool
+    num_receive_requests = num_receivers * len(receive_sizes(message_batch_size))
+
+    # Every receive request, sender, deleter and heartbeat thread can have a request in flight
+    sqs_client = sqs_client or build_client(
+        num_receive_requests + num_workers + max_inflight_deletes + num_heartbeats
+    )
 
-def poll_messages(source_queue_name: str, message_batch_size: int, sqs_client=None):
-    sqs_client = sqs_client or boto3.client("sqs")
     source_url = get_queue_url(sqs_client, source_queue_name)
-    while True:
-        messages = get_messages(sqs_client, source_url, message_batch_size)
-        if not messages:
-            break
+    dest_url = get_queue_url(sqs_client, dest_queue_name)
+
+    total_messages = get_approximate_queue_size(sqs_client, source_url)
+
+    logger.info(
+        "Moving %s messages from %s to %s", total_messages, source_queue_name, dest_queue_name
+    )
 
-        message_bodies = [message.body for message in messages]
-        logger.info("Messages: %s", json.dumps(message_bodies, indent=4))
+    send_queue: "queue.Queue[Optional[Messages]]" = queue.Queue()
+    delete_queue: "queue.Queue[Optional[Messages]]" = queue.Queue()
+    in_flight = threading.BoundedSemaphore(prefetch_batches)
+    in_flight_messages = InFlightMessages()
+    stop = threading.Event()
+    done = threading.Event()
+    progress = MoveProgress()
+
+    # Stage threads hold their workers for the whole move, the receive requests get the rest
+    with ThreadPoolExecutor(
+        max_workers=num_receivers
+        + num_workers
+        + max_inflight_deletes
+        + num_heartbeats
+        + num_receive_requests
+    ) as executor:
+        receivers = [
+            executor.submit(
+                _run_stage,
+                stop,
+                _receive_batches,
+                sqs_client,
+                source_url,
+                message_batch_size,
+                wait_time_seconds,
+                visibility_timeout,
+                executor,
+                send_queue,
+                in_flight,
+                in_flight_messages,
+                stop,
+            )
+            for _ in range(num_receivers)
+        ]
+        senders = [
+            executor.submit(
+                _run_stage,
+                stop,
+                _send_batches,
+                sqs_client,
+                source_url,
+                dest_url,
+                send_queue,
+                delete_queue,
+                in_flight,
+                in_flight_messages,
+                stop,
+            )
+            for _ in range(num_workers)
+        ]
+        deleters = [
+            executor.submit(
+                _run_stage,
+                stop,
+                _delete_batches,
+                sqs_client,
+                source_url,
+                delete_queue,
+                in_flight,
+                in_flight_messages,
+                stop,
+                progress,
+            )
+            for _ in range(max_inflight_deletes)
+        ]
+        heartbeats = [
+            executor.submit(
+                _run_stage,
+                stop,
+                _extend_in_flight,
+                sqs_client,
+                source_url,
+                visibility_timeout,
+                in_flight_messages,
+                done,
+            )
+            for _ in range(num_heartbeats)
+        ]
+
+        try:
+            try:
+                wait(receivers)
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                try:
+                    _close_stage(send_queue, senders)
+                finally:
+                    _close_stage(delete_queue, deleters)
+        finally:
+            done.set()
+
+    for future in receivers + senders + deleters + heartbeats:
+        future.result()
+
+    logger.info("Moved %d total messages", progress.messages)
+
+
+def _dumps(value) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def poll_messages(
+    source_queue_name: str,
+    message_batch_size: int = PREFETCH_COUNT,
+    sqs_client=None,
+    wait_time_seconds: int = WAIT_TIME_SECONDS,
+):
+    sqs_client = sqs_client or build_client()
+    source_url = get_queue_url(sqs_client, source_queue_name)
+    log_messages = logger.isEnabledFor(logging.INFO)
+    with ThreadPoolExecutor(max_workers=len(receive_sizes(message_batch_size))) as executor:
+        while True:
+            messages = get_messages(
+                sqs_client, source_url, message_batch_size, wait_time_seconds, executor=executor
+            )
+            if not messages:
+                break
+
+            # Serializing the bodies is the expensive part, skip it when nothing would be logged
+            if log_messages:
+                logger.info("Messages: %s", _dumps([message.body for message in messages]))
 
 
 def setup_logging(verbose: bool = False):
@@ -149,6 +532,13 @@ def setup_logging(verbose: bool = False):
         logging.basicConfig(format="%(asctime)s %(name)s - %(message)s", level=logging.INFO)
 
 
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return number
+
+
 def run_from_cli():
     parser = argparse.ArgumentParser(description="Move messages between SQS queues.")
     parser.add_argument(
@@ -162,9 +552,42 @@ def run_from_cli():
     parser.add_argument(
         "-b",
         "--batch",
-        help="The number of messages to request each iteration, 10 maximum",
+        help="The number of messages to request each iteration, "
+        "more than 10 are received with concurrent requests",
         required=False,
-        default=10,
+        type=_positive_int,
+        default=PREFETCH_COUNT,
+    )
+    parser.add_argument(
+        "-w",
+        "--wait-time",
+        help="Seconds to long poll for messages when the source queue is empty, 0 to disable",
+        type=int,
+        choices=range(0, WAIT_TIME_SECONDS + 1),
+        metavar="[0-%d]" % WAIT_TIME_SECONDS,
+        default=WAIT_TIME_SECONDS,
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="The number of threads receiving messages from the source queue in parallel",
+        type=_positive_int,
+        default=NUM_RECEIVERS,
+    )
+    parser.add_argument(
+        "-t",
+        "--visibility-timeout",
+        help="Seconds received messages are hidden from other consumers, extended while they are "
+        "being moved. Defaults to the source queue's visibility timeout",
+        type=_positive_int,
+        default=None,
+    )
+    parser.add_argument(
+        "-a",
+        "--async",
+        dest="use_async",
+        help="Move messages with asyncio, requires aioboto3 (pip install sqs_mover[async])",
+        action="store_true",
     )
     parser.add_argument(
         "-v",
@@ -178,12 +601,38 @@ def run_from_cli():
         setup_logging(verbose=True)
     else:
         setup_logging()
+    if not args.poll and not args.dest:
+        parser.error("-d argument is required if not polling")
+
+    if args.use_async and not args.poll:
+        from sqs_mover.async_mover import aioboto3, move_messages_async
+
+        if aioboto3 is not None:
+            asyncio.run(
+                move_messages_async(
+                    args.source,
+                    args.dest,
+                    args.batch,
+                    wait_time_seconds=args.wait_time,
+                    num_receivers=args.concurrency,
+                    visibility_timeout=args.visibility_timeout,
+                )
+            )
+            return
+
+        logger.warning("aioboto3 is not installed, moving messages using threads")
+
     if args.poll:
-        poll_messages(args.source, args.batch)
+        poll_messages(args.source, args.batch, wait_time_seconds=args.wait_time)
     else:
-        if not args.dest:
-            parser.error("-d argument is required if not polling")
-        move_messages(args.source, args.dest, args.batch)
+        move_messages(
+            args.source,
+            args.dest,
+            args.batch,
+            wait_time_seconds=args.wait_time,
+            num_receivers=args.concurrency,
+            visibility_timeout=args.visibility_timeout,
+        )
 
 
 if __name__ == "__main__":
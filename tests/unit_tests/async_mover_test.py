@@ -0,0 +1,268 @@
+import asyncio
+
+import pytest
+
+from unittest.mock import AsyncMock, call, patch
+
+from sqs_mover.async_mover import get_messages, move_messages_async
+from sqs_mover.common import Message, WAIT_TIME_SECONDS
+
+
+def _sqs_client(receive_responses):
+    sqs_client = AsyncMock()
+
+    sqs_client.get_queue_url.side_effect = lambda QueueName: {"QueueUrl": "http://" + QueueName}
+    sqs_client.get_queue_attributes.return_value = {
+        "Attributes": {"ApproximateNumberOfMessages": "20"}
+    }
+    sqs_client.receive_message.side_effect = receive_responses
+    sqs_client.send_message_batch.return_value = {}
+    sqs_client.delete_message_batch.return_value = {}
+    sqs_client.change_message_visibility_batch.return_value = {}
+
+    return sqs_client
+
+
+def _raw_message(i):
+    return {"MessageId": i, "Body": str(i), "ReceiptHandle": str(i)}
+
+
+def test_get_messages_returns_messages():
+    sqs_client = _sqs_client([{"Messages": [_raw_message(1)]}])
+
+    messages = asyncio.run(get_messages(sqs_client, "my-queue", 1))
+
+    assert messages == [Message(1, "1", {}, "1")]
+    sqs_client.receive_message.assert_awaited_once_with(
+        QueueUrl="my-queue",
+        MaxNumberOfMessages=1,
+        WaitTimeSeconds=WAIT_TIME_SECONDS,
+    )
+
+
+def test_get_messages_splits_large_batches_into_concurrent_requests():
+    sqs_client = _sqs_client(
+        lambda MaxNumberOfMessages, **kwargs: {
+            "Messages": [_raw_message(i) for i in range(MaxNumberOfMessages)]
+        }
+    )
+
+    messages = asyncio.run(get_messages(sqs_client, "my-queue", 25))
+
+    assert len(messages) == 25
+    assert [
+        receive_call.kwargs["MaxNumberOfMessages"]
+        for receive_call in sqs_client.receive_message.await_args_list
+    ] == [10, 10, 5]
+
+
+def test_move_messages_async_moves_in_bulks():
+    sqs_client = _sqs_client(
+        [{"Messages": [_raw_message(1), _raw_message(2)]}, {"Messages": [_raw_message(3)]}, {}]
+    )
+
+    asyncio.run(
+        move_messages_async(
+            "source", "dest", 2, sqs_client=sqs_client, num_workers=1, num_receivers=1
+        )
+    )
+
+    assert sqs_client.receive_message.await_count == 3
+    assert sqs_client.receive_message.await_args.kwargs["MessageAttributeNames"] == ["All"]
+    assert sqs_client.send_message_batch.await_args_list == [
+        call(
+            QueueUrl="http://dest",
+            Entries=[
+                {"Id": 1, "MessageBody": "1"},
+                {"Id": 2, "MessageBody": "2"},
+            ],
+        ),
+        call(QueueUrl="http://dest", Entries=[{"Id": 3, "MessageBody": "3"}]),
+    ]
+    assert sqs_client.delete_message_batch.await_args_list == [
+        call(
+            QueueUrl="http://source",
+            Entries=[{"Id": 1, "ReceiptHandle": "1"}, {"Id": 2, "ReceiptHandle": "2"}],
+        ),
+        call(QueueUrl="http://source", Entries=[{"Id": 3, "ReceiptHandle": "3"}]),
+    ]
+
+
+def test_move_messages_async_stops_on_failed_send():
+    sqs_client = _sqs_client(lambda **kwargs: {"Messages": [_raw_message(1)]})
+    sqs_client.send_message_batch.return_value = {"Failed": [{"Id": 1}]}
+
+    asyncio.run(
+        move_messages_async(
+            "source", "dest", 1, sqs_client=sqs_client, num_workers=1, num_receivers=1
+        )
+    )
+
+    sqs_client.send_message_batch.assert_awaited_once()
+    sqs_client.delete_message_batch.assert_not_awaited()
+    # Batches received before the stop are released back to the source queue
+    sqs_client.change_message_visibility_batch.assert_awaited_with(
+        QueueUrl="http://source",
+        Entries=[{"Id": 1, "ReceiptHandle": "1", "VisibilityTimeout": 0}],
+    )
+
+
+def test_move_messages_async_stops_on_failed_delete():
+    sqs_client = _sqs_client(lambda **kwargs: {"Messages": [_raw_message(1)]})
+    sqs_client.delete_message_batch.return_value = {"Failed": [{"Id": 1}]}
+
+    asyncio.run(
+        move_messages_async(
+            "source", "dest", 1, sqs_client=sqs_client, num_workers=1, num_receivers=1
+        )
+    )
+
+    # Deletes run in the background, every batch that was sent is still deleted
+    assert sqs_client.delete_message_batch.await_count == sqs_client.send_message_batch.await_count
+
+
+def test_move_messages_async_deletes_sent_batches_when_a_send_raises():
+    sqs_client = _sqs_client([{"Messages": [_raw_message(i)]} for i in range(2)] + [{}])
+    sqs_client.send_message_batch.side_effect = [{}, Exception("send failed")]
+    deleted_entries = []
+
+    async def delete_message_batch(QueueUrl, Entries):
+        await asyncio.sleep(0.05)
+        deleted_entries.extend(Entries)
+        return {}
+
+    sqs_client.delete_message_batch.side_effect = delete_message_batch
+
+    with pytest.raises(Exception, match="send failed"):
+        asyncio.run(
+            move_messages_async(
+                "source", "dest", 1, sqs_client=sqs_client, num_workers=1, num_receivers=1
+            )
+        )
+
+    assert deleted_entries == [{"Id": 0, "ReceiptHandle": "0"}]
+
+
+def _entry_ids(mock_method):
+    return [
+        entry["Id"]
+        for await_call in mock_method.await_args_list
+        for entry in await_call.kwargs["Entries"]
+    ]
+
+
+def test_move_messages_async_releases_queued_batches_when_a_receive_raises():
+    sqs_client = _sqs_client(
+        [{"Messages": [_raw_message(i)]} for i in range(3)] + [Exception("receive failed")]
+    )
+
+    async def send_message_batch(**kwargs):
+        await asyncio.sleep(0.01)
+        return {}
+
+    sqs_client.send_message_batch.side_effect = send_message_batch
+
+    with pytest.raises(Exception, match="receive failed"):
+        asyncio.run(
+            move_messages_async(
+                "source", "dest", 1, sqs_client=sqs_client, num_workers=1, num_receivers=1
+            )
+        )
+
+    # Every received message was either moved or made visible again
+    moved = _entry_ids(sqs_client.delete_message_batch)
+    released = _entry_ids(sqs_client.change_message_visibility_batch)
+    assert released
+    assert sorted(moved + released) == [0, 1, 2]
+
+
+def test_move_messages_async_releases_queued_batches_when_a_send_raises():
+    sqs_client = _sqs_client([{"Messages": [_raw_message(i)]} for i in range(3)] + [{}])
+    sqs_client.send_message_batch.side_effect = Exception("send failed")
+
+    with pytest.raises(Exception, match="send failed"):
+        asyncio.run(
+            move_messages_async(
+                "source", "dest", 1, sqs_client=sqs_client, num_workers=1, num_receivers=1
+            )
+        )
+
+    # Every received message that wasn't sent was made visible again
+    received = list(range(min(sqs_client.receive_message.await_count, 3)))
+    released = _entry_ids(sqs_client.change_message_visibility_batch)
+    assert sorted(released + _entry_ids(sqs_client.send_message_batch)) == received
+    sqs_client.delete_message_batch.assert_not_awaited()
+
+
+def test_move_messages_async_bounds_concurrent_deletes():
+    sqs_client = _sqs_client([{"Messages": [_raw_message(i)]} for i in range(5)] + [{}])
+    running_deletes = []
+    max_running_deletes = 0
+
+    async def delete_message_batch(**kwargs):
+        nonlocal max_running_deletes
+        running_deletes.append(kwargs)
+        max_running_deletes = max(max_running_deletes, len(running_deletes))
+        await asyncio.sleep(0.01)
+        running_deletes.remove(kwargs)
+        return {}
+
+    sqs_client.delete_message_batch.side_effect = delete_message_batch
+
+    asyncio.run(
+        move_messages_async(
+            "source",
+            "dest",
+            1,
+            sqs_client=sqs_client,
+            num_workers=2,
+            num_receivers=1,
+            max_inflight_deletes=2,
+        )
+    )
+
+    assert sqs_client.delete_message_batch.await_count == 5
+    assert max_running_deletes == 2
+
+
+def test_move_messages_async_extends_batches_in_flight():
+    sqs_client = _sqs_client([{"Messages": [_raw_message(1)]}, {}])
+
+    # A send slower than half the visibility timeout
+    async def send_message_batch(**kwargs):
+        await asyncio.sleep(0.8)
+        return {}
+
+    sqs_client.send_message_batch.side_effect = send_message_batch
+
+    asyncio.run(
+        move_messages_async(
+            "source", "dest", 1, sqs_client=sqs_client, num_receivers=1, visibility_timeout=1
+        )
+    )
+
+    assert sqs_client.receive_message.await_args.kwargs["VisibilityTimeout"] == 1
+    sqs_client.change_message_visibility_batch.assert_awaited_with(
+        QueueUrl="http://source",
+        Entries=[{"Id": 1, "ReceiptHandle": "1", "VisibilityTimeout": 1}],
+    )
+
+
+@patch("sqs_mover.async_mover.aioboto3", None)
+def test_move_messages_async_requires_aioboto3_without_a_client():
+    with pytest.raises(ImportError, match="sqs_mover\\[async\\]"):
+        asyncio.run(move_messages_async("source", "dest"))
+
+
+@pytest.mark.parametrize(
+    "pipeline_size", ["num_workers", "prefetch_batches", "max_inflight_deletes"]
+)
+def test_move_messages_async_rejects_empty_pipeline_stages(pipeline_size):
+    sqs_client = _sqs_client([])
+
+    with pytest.raises(ValueError, match=pipeline_size):
+        asyncio.run(
+            move_messages_async("source", "dest", sqs_client=sqs_client, **{pipeline_size: 0})
+        )
+
+    sqs_client.receive_message.assert_not_awaited()
@@ -0,0 +1,27 @@
+from unittest.mock import patch
+
+from sqs_mover.client import build_client, MAX_POOL_CONNECTIONS
+
+
+@patch("sqs_mover.client._session", None)
+@patch("boto3.session.Session")
+def test_build_client_shares_session(session_class):
+    build_client()
+    build_client()
+
+    session_class.assert_called_once_with()
+    assert session_class.return_value.client.call_count == 2
+
+
+@patch("sqs_mover.client._session", None)
+@patch("boto3.session.Session")
+def test_build_client_sizes_connection_pool(session_class):
+    build_client(10)
+    build_client(100)
+
+    pool_sizes = [
+        client_call.kwargs["config"].max_pool_connections
+        for client_call in session_class.return_value.client.call_args_list
+    ]
+    assert pool_sizes == [MAX_POOL_CONNECTIONS, 100]
+    assert session_class.return_value.client.call_args.kwargs["config"].tcp_keepalive
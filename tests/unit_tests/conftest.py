@@ -0,0 +1,16 @@
+import boto3
+import pytest
+
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(scope="session")
+def _real_sqs_client():
+    # Building a real client is slow, so it's only built once to spec the mocks
+    return boto3.client("sqs", region_name="us-east-1")
+
+
+@pytest.fixture
+def sqs_client(_real_sqs_client):
+    """A mock SQS client that rejects methods the real client doesn't have."""
+    return MagicMock(spec_set=_real_sqs_client)
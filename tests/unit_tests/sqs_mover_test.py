@@ -1,117 +1,296 @@
-from unittest.mock import Mock, patch, call
+import gc
+import logging
+import threading
+import time
+import weakref
+
+import pytest
+
+from unittest.mock import ANY, Mock, patch, call
 
 from sqs_mover.sqs_mover import (
     setup_logging,
+    get_queue_url,
+    get_approximate_queue_size,
     get_messages,
     send_messages,
     delete_messages,
+    release_messages,
+    extend_visibility,
     move_messages,
-    Message,
+    poll_messages,
+    WAIT_TIME_SECONDS,
+    _dumps,
+    _extend_in_flight,
 )
-
+from sqs_mover.common import InFlightMessages, Message
 
 setup_logging()
 
 
-def test_get_messages_returns_messages():
+def test_get_queue_url_is_cached():
+    sqs_client = Mock()
+
+    sqs_client.get_queue_url.return_value = {"QueueUrl": "http://my-queue"}
+
+    assert get_queue_url(sqs_client, "my-queue") == "http://my-queue"
+    assert get_queue_url(sqs_client, "my-queue") == "http://my-queue"
+
+    sqs_client.get_queue_url.assert_called_once_with(QueueName="my-queue")
+
+
+def test_get_queue_url_is_cached_per_client():
     sqs_client = Mock()
-    attributes = {"environment": "staging"}
+    another_client = Mock()
+    # Clients with different credentials in the same region share an endpoint
+    another_client.meta.endpoint_url = sqs_client.meta.endpoint_url = "https://sqs.example"
+
+    sqs_client.get_queue_url.return_value = {"QueueUrl": "http://111111111111/dlq"}
+    another_client.get_queue_url.return_value = {"QueueUrl": "http://222222222222/dlq"}
+
+    assert get_queue_url(sqs_client, "dlq") == "http://111111111111/dlq"
+    assert get_queue_url(another_client, "dlq") == "http://222222222222/dlq"
+
+
+def test_get_queue_url_does_not_keep_clients_alive():
+    sqs_client = Mock()
+    client_ref = weakref.ref(sqs_client)
+
+    sqs_client.get_queue_url.return_value = {"QueueUrl": "http://my-queue"}
+    get_queue_url(sqs_client, "my-queue")
+
+    del sqs_client
+    gc.collect()
+
+    assert client_ref() is None
 
+
+def test_get_queue_url_does_not_cache_failures():
+    sqs_client = Mock()
+
+    sqs_client.get_queue_url.side_effect = [Exception("missing queue"), {"QueueUrl": "http://new"}]
+
+    with pytest.raises(Exception):
+        get_queue_url(sqs_client, "new")
+    assert get_queue_url(sqs_client, "new") == "http://new"
+
+
+def test_get_approximate_queue_size_is_cached():
+    sqs_client = Mock()
+
+    sqs_client.get_queue_attributes.return_value = {
+        "Attributes": {"ApproximateNumberOfMessages": "20"}
+    }
+
+    assert get_approximate_queue_size(sqs_client, "http://cached-queue") == "20"
+    assert get_approximate_queue_size(sqs_client, "http://cached-queue") == "20"
+
+    sqs_client.get_queue_attributes.assert_called_once_with(
+        QueueUrl="http://cached-queue", AttributeNames=["ApproximateNumberOfMessages"]
+    )
+
+
+@pytest.mark.parametrize(
+    "receive_response, expected_messages",
+    [
+        ({}, []),
+        (
+            {"Messages": [{"MessageId": "1", "Body": "message", "ReceiptHandle": "1234"}]},
+            [Message("1", "message", {}, "1234")],
+        ),
+        (
+            {
+                "Messages": [
+                    {
+                        "MessageId": "1",
+                        "Body": "message",
+                        "MessageAttributes": {"environment": "staging"},
+                        "ReceiptHandle": "1234",
+                    }
+                ]
+            },
+            [Message("1", "message", {"environment": "staging"}, "1234")],
+        ),
+    ],
+)
+def test_get_messages_returns_messages(sqs_client, receive_response, expected_messages):
+    sqs_client.receive_message.return_value = receive_response
+
+    messages = get_messages(sqs_client, "my-queue", 1)
+
+    assert messages == expected_messages
+
+
+def test_get_messages_without_attributes_share_read_only_attributes(sqs_client):
     sqs_client.receive_message.return_value = {
         "Messages": [
-            {
-                "MessageId": 1,
-                "Body": "message",
-                "MessageAttributes": attributes,
-                "ReceiptHandle": "1234",
-            }
+            {"MessageId": "1", "Body": "message", "ReceiptHandle": "1234"},
+            {"MessageId": "2", "Body": "another", "ReceiptHandle": "5678"},
         ]
     }
 
-    messages = get_messages(sqs_client, "my-queue", 1)
+    first, second = get_messages(sqs_client, "my-queue", 2)
+
+    assert first.attributes is second.attributes
+    with pytest.raises(TypeError):
+        first.attributes["environment"] = "staging"
+    assert second.attributes == {}
+
+
+@pytest.mark.parametrize(
+    "receive_options, request_options",
+    [
+        ({}, {"WaitTimeSeconds": WAIT_TIME_SECONDS}),
+        ({"wait_time_seconds": 0}, {"WaitTimeSeconds": 0}),
+        (
+            {"visibility_timeout": 60},
+            {"WaitTimeSeconds": WAIT_TIME_SECONDS, "VisibilityTimeout": 60},
+        ),
+        (
+            {"message_attribute_names": ["All"]},
+            {"WaitTimeSeconds": WAIT_TIME_SECONDS, "MessageAttributeNames": ["All"]},
+        ),
+    ],
+)
+def test_get_messages_sends_receive_options(sqs_client, receive_options, request_options):
+    sqs_client.receive_message.return_value = {}
 
-    assert messages == (Message(1, "message", attributes, "1234"),)
+    get_messages(sqs_client, "my-queue", 1, **receive_options)
 
     sqs_client.receive_message.assert_called_once_with(
-        QueueUrl="my-queue", MaxNumberOfMessages=1, MessageAttributeNames=["All"]
+        QueueUrl="my-queue", MaxNumberOfMessages=1, **request_options
     )
 
 
-def test_get_messages_supports_empty_response():
-    sqs_client = Mock()
+def test_get_messages_splits_large_batches_into_concurrent_requests(sqs_client):
+    def _receive_message(MaxNumberOfMessages, **kwargs):
+        return {
+            "Messages": [
+                {"MessageId": i, "Body": str(i), "ReceiptHandle": str(i)}
+                for i in range(MaxNumberOfMessages)
+            ]
+        }
 
-    sqs_client.receive_message.return_value = {}
+    sqs_client.receive_message.side_effect = _receive_message
 
-    messages = get_messages(sqs_client, "my-queue", 1)
+    messages = get_messages(sqs_client, "my-queue", 25)
 
-    assert messages == tuple()
+    assert len(messages) == 25
+    assert sorted(
+        receive_call.kwargs["MaxNumberOfMessages"]
+        for receive_call in sqs_client.receive_message.call_args_list
+    ) == [5, 10, 10]
 
 
-def test_get_messages_supports_empty_attributes():
-    sqs_client = Mock()
+def test_get_messages_receives_on_the_given_executor(sqs_client):
+    sqs_client.receive_message.return_value = {}
+    executor = Mock()
+    executor.map.side_effect = map
 
-    sqs_client.receive_message.return_value = {
-        "Messages": [{"MessageId": 1, "Body": "message", "ReceiptHandle": "1234"}]
+    get_messages(sqs_client, "my-queue", 25, executor=executor)
+
+    executor.map.assert_called_once()
+    assert sqs_client.receive_message.call_count == 3
+
+
+def test_get_messages_reports_each_request_as_it_returns(sqs_client):
+    sqs_client.receive_message.side_effect = lambda MaxNumberOfMessages, **kwargs: {
+        "Messages": [
+            {"MessageId": str(i), "Body": str(i), "ReceiptHandle": str(i)}
+            for i in range(MaxNumberOfMessages)
+        ]
     }
+    on_received = Mock()
 
-    messages = get_messages(sqs_client, "my-queue", 1)
+    messages = get_messages(sqs_client, "my-queue", 25, on_received=on_received)
 
-    assert messages == (Message(1, "message", {}, "1234"),)
+    assert sorted(len(received_call.args[0]) for received_call in on_received.call_args_list) == [
+        5,
+        10,
+        10,
+    ]
+    assert len(messages) == 25
 
 
-def test_send_messagse_sends_messages():
-    sqs_client = Mock()
+@pytest.mark.parametrize(
+    "send_response, failed_indexes",
+    [({}, []), ({"Failed": [{"Id": 2}]}, [1])],
+)
+def test_send_messages_sends_messages(sqs_client, send_response, failed_indexes):
+    sqs_client.send_message_batch.return_value = send_response
 
-    sqs_client.send_message_batch.return_value = {}
+    attributes = {"environment": {"DataType": "String", "StringValue": "staging"}}
+    messages = [Message(1, "message", {}, "1234"), Message(2, "another", attributes, "5678")]
 
-    failed_messages = send_messages(sqs_client, "my-queue", (Message(1, "message", {}, "1234"),))
+    failed_messages = send_messages(sqs_client, "my-queue", messages)
 
     sqs_client.send_message_batch.assert_called_once_with(
-        QueueUrl="my-queue", Entries=[{"Id": 1, "MessageBody": "message", "MessageAttributes": {}}]
+        QueueUrl="my-queue",
+        Entries=[
+            {"Id": 1, "MessageBody": "message"},
+            {"Id": 2, "MessageBody": "another", "MessageAttributes": attributes},
+        ],
     )
 
-    assert failed_messages == tuple()
+    assert failed_messages == [messages[index] for index in failed_indexes]
 
 
-def test_send_messagse_returns_failed_messages():
-    sqs_client = Mock()
-
-    sqs_client.send_message_batch.return_value = {"Failed": [{"MessageId": 2}]}
+def test_send_messages_splits_large_batches(sqs_client):
+    sqs_client.send_message_batch.return_value = {"Failed": [{"Id": 11}]}
 
-    messages = (Message(1, "message", {}, "1234"), Message(2, "another", {}, "5678"))
+    messages = [Message(i, str(i), {}, str(i)) for i in range(12)]
 
     failed_messages = send_messages(sqs_client, "my-queue", messages)
-    assert failed_messages == messages[1:]
 
+    assert [
+        len(send_call.kwargs["Entries"])
+        for send_call in sqs_client.send_message_batch.call_args_list
+    ] == [10, 2]
+    assert failed_messages == [messages[11]]
 
-def test_delete_messages_deletes_messages():
-    sqs_client = Mock()
 
-    sqs_client.delete_message_batch.return_value = {}
+@pytest.mark.parametrize(
+    "delete_response, failed_indexes",
+    [({}, []), ({"Failed": [{"Id": 2}]}, [1])],
+)
+def test_delete_messages_deletes_messages(sqs_client, delete_response, failed_indexes):
+    sqs_client.delete_message_batch.return_value = delete_response
 
-    failed_messages = delete_messages(sqs_client, "my-queue", (Message(1, "message", {}, "1234"),))
+    messages = [Message(1, "message", {}, "1234"), Message(2, "another", {}, "5678")]
+    failed_messages = delete_messages(sqs_client, "my-queue", messages)
 
     sqs_client.delete_message_batch.assert_called_once_with(
-        QueueUrl="my-queue", Entries=[{"Id": 1, "ReceiptHandle": "1234"}]
+        QueueUrl="my-queue",
+        Entries=[{"Id": 1, "ReceiptHandle": "1234"}, {"Id": 2, "ReceiptHandle": "5678"}],
     )
 
-    assert failed_messages == tuple()
+    assert failed_messages == [messages[index] for index in failed_indexes]
 
 
-def test_delete_messages_returns_failed_messages():
-    sqs_client = Mock()
+def test_release_messages_makes_messages_visible(sqs_client):
+    sqs_client.change_message_visibility_batch.return_value = {}
 
-    sqs_client.delete_message_batch.return_value = {"Failed": [{"MessageId": 2}]}
+    failed_messages = release_messages(sqs_client, "my-queue", [Message(1, "message", {}, "1234")])
 
-    messages = (Message(1, "message", {}, "1234"), Message(2, "another", {}, "5678"))
-    failed_messages = delete_messages(sqs_client, "my-queue", messages)
+    sqs_client.change_message_visibility_batch.assert_called_once_with(
+        QueueUrl="my-queue", Entries=[{"Id": 1, "ReceiptHandle": "1234", "VisibilityTimeout": 0}]
+    )
 
-    sqs_client.delete_message_batch.assert_called_once_with(
-        QueueUrl="my-queue",
-        Entries=[{"Id": 1, "ReceiptHandle": "1234"}, {"Id": 2, "ReceiptHandle": "5678"}],
+    assert failed_messages == []
+
+
+def test_extend_visibility_hides_messages(sqs_client):
+    sqs_client.change_message_visibility_batch.return_value = {}
+
+    failed_messages = extend_visibility(
+        sqs_client, "my-queue", [Message(1, "message", {}, "1234")], 60
+    )
+
+    sqs_client.change_message_visibility_batch.assert_called_once_with(
+        QueueUrl="my-queue", Entries=[{"Id": 1, "ReceiptHandle": "1234", "VisibilityTimeout": 60}]
     )
 
-    assert failed_messages == tuple(messages[1:])
+    assert failed_messages == []
 
 
 @patch("sqs_mover.sqs_mover.get_approximate_queue_size", Mock(return_value=20))
@@ -123,10 +302,10 @@ def test_move_messages_moves_in_bulks(get_queue_url, get_messages, send_messages
     sqs_client = Mock()
 
     messages = [Message(i, str(i), {}, str(i)) for i in range(10)]
-    batches = [messages[:5], messages[5:], tuple()]
+    batches = [messages[:5], messages[5:], []]
 
-    send_messages.side_effect = [tuple(), tuple()]
-    delete_messages.side_effect = [tuple(), tuple()]
+    send_messages.side_effect = [[], []]
+    delete_messages.side_effect = [[], []]
 
     def _get_queue_url(_, queue_name):
         return {"source": "http://source", "dest": "http://dest"}[queue_name]
@@ -134,10 +313,28 @@ def test_move_messages_moves_in_bulks(get_queue_url, get_messages, send_messages
     get_queue_url.side_effect = _get_queue_url
     get_messages.side_effect = batches
 
-    move_messages("source", "dest", 1, sqs_client=sqs_client)
+    move_messages(
+        "source",
+        "dest",
+        1,
+        sqs_client=sqs_client,
+        num_workers=1,
+        num_receivers=1,
+        max_inflight_deletes=1,
+    )
 
     assert get_queue_url.call_args_list == [call(sqs_client, "source"), call(sqs_client, "dest")]
-    assert get_messages.call_args_list == [call(sqs_client, "http://source", 1)] * 3
+    assert get_messages.call_count == 3
+    assert get_messages.call_args == call(
+        sqs_client,
+        "http://source",
+        1,
+        WAIT_TIME_SECONDS,
+        None,
+        ["All"],
+        executor=ANY,
+        on_received=ANY,
+    )
     assert send_messages.call_args_list == [
         call(sqs_client, "http://dest", batches[0]),
         call(sqs_client, "http://dest", batches[1]),
@@ -146,3 +343,149 @@ def test_move_messages_moves_in_bulks(get_queue_url, get_messages, send_messages
         call(sqs_client, "http://source", batches[0]),
         call(sqs_client, "http://source", batches[1]),
     ]
+
+
+@patch("sqs_mover.sqs_mover.get_approximate_queue_size", Mock(return_value=20))
+@patch("sqs_mover.sqs_mover.release_messages")
+@patch("sqs_mover.sqs_mover.delete_messages")
+@patch("sqs_mover.sqs_mover.send_messages")
+@patch("sqs_mover.sqs_mover.get_messages")
+@patch("sqs_mover.sqs_mover.get_queue_url", Mock(return_value="http://queue"))
+def test_move_messages_stops_on_failed_send(
+    get_messages, send_messages, delete_messages, release_messages
+):
+    sqs_client = Mock()
+
+    batch = [Message(1, "message", {}, "1234")]
+    another_received = threading.Event()
+
+    def _get_messages(*args, **kwargs):
+        if get_messages.call_count > 1:
+            another_received.set()
+        return batch
+
+    # Fail the send once another batch was received, which is drained and released on stop
+    def _send_messages(*args):
+        another_received.wait(timeout=1)
+        return batch
+
+    get_messages.side_effect = _get_messages
+    send_messages.side_effect = _send_messages
+    release_messages.return_value = []
+
+    move_messages("source", "dest", 1, sqs_client=sqs_client, num_workers=1, num_receivers=1)
+
+    send_messages.assert_called_once_with(sqs_client, "http://queue", batch)
+    release_messages.assert_called_with(sqs_client, "http://queue", batch)
+    delete_messages.assert_not_called()
+
+
+@patch("sqs_mover.sqs_mover.get_approximate_queue_size", Mock(return_value=20))
+@patch("sqs_mover.sqs_mover.delete_messages", Mock(return_value=[]))
+@patch("sqs_mover.sqs_mover.send_messages", Mock(return_value=[]))
+@patch("sqs_mover.sqs_mover.get_messages")
+@patch("sqs_mover.sqs_mover.get_queue_url", Mock(return_value="http://queue"))
+def test_move_messages_runs_until_all_receivers_finish(get_messages):
+    sqs_client = Mock()
+
+    batches = [[Message(i, str(i), {}, str(i))] for i in range(6)]
+    get_messages.side_effect = batches + [[]] * 3
+
+    move_messages("source", "dest", 1, sqs_client=sqs_client, num_receivers=3)
+
+    assert get_messages.call_count == 9
+
+
+@patch("sqs_mover.sqs_mover.get_approximate_queue_size", Mock(return_value=20))
+@patch("sqs_mover.sqs_mover.extend_visibility")
+@patch("sqs_mover.sqs_mover.delete_messages", Mock(return_value=[]))
+@patch("sqs_mover.sqs_mover.send_messages")
+@patch("sqs_mover.sqs_mover.get_messages")
+@patch("sqs_mover.sqs_mover.get_queue_url", Mock(return_value="http://queue"))
+def test_move_messages_extends_batches_in_flight(get_messages, send_messages, extend_visibility):
+    sqs_client = Mock()
+
+    extend_visibility.return_value = []
+
+    batch = [Message(1, "message", {}, "1234")]
+    batches = iter([batch, []])
+
+    def _get_messages(*args, on_received, **kwargs):
+        messages = next(batches)
+        on_received(messages)
+        return messages
+
+    get_messages.side_effect = _get_messages
+
+    # A send slower than half the visibility timeout
+    send_messages.side_effect = lambda *args: time.sleep(0.8) or []
+
+    move_messages("source", "dest", 1, sqs_client=sqs_client, num_receivers=1, visibility_timeout=1)
+
+    assert get_messages.call_args == call(
+        sqs_client, "http://queue", 1, WAIT_TIME_SECONDS, 1, ["All"], executor=ANY, on_received=ANY
+    )
+    extend_visibility.assert_called_with(sqs_client, "http://queue", batch, 1)
+
+
+def test_extend_in_flight_ignores_messages_no_longer_in_flight(caplog):
+    sqs_client = Mock()
+    batch = [Message("1", "message", {}, "1234")]
+    in_flight_messages = InFlightMessages()
+    in_flight_messages.add(batch)
+    done = threading.Event()
+
+    # The batch is deleted while its visibility is being extended, so the extension fails
+    def _extend_visibility(*args):
+        in_flight_messages.remove(batch)
+        done.set()
+        return batch
+
+    with patch("sqs_mover.sqs_mover.extend_visibility", side_effect=_extend_visibility):
+        _extend_in_flight(sqs_client, "http://queue", 1, in_flight_messages, done)
+
+    assert done.is_set()
+    assert "Failed to extend visibility" not in caplog.text
+
+
+@pytest.mark.parametrize(
+    "pipeline_size",
+    [
+        "message_batch_size",
+        "num_workers",
+        "prefetch_batches",
+        "num_receivers",
+        "max_inflight_deletes",
+    ],
+)
+def test_move_messages_rejects_empty_pipeline_stages(pipeline_size):
+    sqs_client = Mock()
+
+    with pytest.raises(ValueError, match=pipeline_size):
+        move_messages("source", "dest", sqs_client=sqs_client, **{pipeline_size: 0})
+
+    sqs_client.receive_message.assert_not_called()
+
+
+def test_dumps_is_compact_and_keeps_non_ascii_with_and_without_orjson():
+    bodies = ["héllo", '{"key": "value"}', "日本語"]
+    expected = '["héllo","{\\"key\\": \\"value\\"}","日本語"]'
+
+    assert _dumps(bodies) == expected
+    with patch("sqs_mover.sqs_mover.orjson", None):
+        assert _dumps(bodies) == expected
+
+
+@pytest.mark.parametrize("log_level, serialized", [(logging.INFO, True), (logging.WARNING, False)])
+def test_poll_messages_only_serializes_logged_messages(sqs_client, caplog, log_level, serialized):
+    sqs_client.receive_message.side_effect = [
+        {"Messages": [{"MessageId": "1", "Body": "message", "ReceiptHandle": "1234"}]},
+        {},
+    ]
+    caplog.set_level(log_level, logger="sqs_mover")
+
+    with patch("sqs_mover.sqs_mover._dumps", return_value="[]") as dumps:
+        poll_messages("source", 1, sqs_client=sqs_client)
+
+    assert dumps.called == serialized
+    assert sqs_client.receive_message.call_count == 2